@@ -47,20 +47,40 @@ export default function Transform () {
     try {
       setConverting(true)
 
-      const response = await axios.post(
+      // Queue the conversion; the backend answers 202 with a job id right away
+      const { data: job } = await axios.post<{ jobId: string; downloadName: string }>(
         'http://127.0.0.1:8080/api/convert',
         {
           filename,
           targetGenre: selectedGenre
         },
         {
-          responseType: 'blob',
           headers: {
             'Content-Type': 'application/json'
           }
         }
       )
 
+      // Poll the job until the transformed file comes back (202 = still running)
+      // (jobs are shared between identical uploads, so pass our own download name along)
+      const jobUrl = `http://127.0.0.1:8080/api/convert/${job.jobId}?downloadName=${encodeURIComponent(job.downloadName)}`
+      // Give up after 15 minutes: longer than the backend lets FFmpeg run (10 minutes) plus
+      // time spent queued behind other conversions
+      const deadline = Date.now() + 15 * 60 * 1000
+      let response = await axios.get(jobUrl, { responseType: 'blob' })
+      while (response.status === 202) {
+        if (Date.now() > deadline) {
+          toast({
+            title: 'Conversion Failed',
+            description: 'The conversion is taking too long. Please try again later.',
+            variant: 'destructive'
+          })
+          return
+        }
+        await new Promise(resolve => setTimeout(resolve, 1000))
+        response = await axios.get(jobUrl, { responseType: 'blob' })
+      }
+
       console.log('Response:', response)
       console.log('Response headers:', response.headers)
 
@@ -1,9 +1,16 @@
 import os
 from flask import Flask, jsonify
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 from dotenv import load_dotenv
 import logging
 
+# orjson is a much faster JSON encoder; use it for responses when it's installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # Import routes
 from python_backend.routes.uploads import uploads_bp
 
@@ -17,14 +24,40 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson (types it can't handle go through Flask's default)"""
+    
+    # Produce what DefaultJSONProvider would: sorted keys, non-str keys (e.g. {1: ...})
+    # stringified instead of rejected, and datetimes handed to Flask's default (HTTP dates)
+    # rather than orjson's ISO 8601
+    OPTIONS = orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME if orjson else 0
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=self.OPTIONS).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 def create_app():
     """Create and configure the Flask application"""
     # Create the Flask app
     app = Flask(__name__)
     
+    # Serialize jsonify()/request.json with orjson when available
+    if orjson is not None:
+        app.json = OrjsonProvider(app)
+    
     # Allow CORS for all routes
     CORS(app)
     
+    # Reject oversized uploads before they are read into memory. 200 MB fits about
+    # 19 minutes of 44.1kHz stereo 16-bit WAV, so full-length lossless tracks get through
+    app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_UPLOAD_MB', 200)) * 1024 * 1024
+    
+    # Behind a server that understands X-Sendfile, let it stream files instead of Python.
+    # Otherwise send_file hands the open file to wsgi.file_wrapper (sendfile(2) under gunicorn).
+    app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE') == '1'
+    
     # Register blueprints
     app.register_blueprint(uploads_bp)
     
@@ -41,6 +74,10 @@ def create_app():
     def not_found(e):
         return jsonify({'error': 'Not found'}), 404
     
+    @app.errorhandler(413)
+    def too_large(e):
+        return jsonify({'error': 'File too large'}), 413
+    
     @app.errorhandler(500)
     def server_error(e):
         logger.error(f"Server error: {e}")
@@ -49,10 +86,11 @@ def create_app():
     return app
 
 if __name__ == '__main__':
+    # Development server only; see "Running in Production" in the README for gunicorn
     app = create_app()
     
     # Get port from environment, default to 8080
     port = int(os.environ.get('PORT', 8080))
     
     # Run the app
-    app.run(host='0.0.0.0', port=port, debug=True)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=port)
\ No newline at end of file
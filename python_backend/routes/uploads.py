@@ -1,17 +1,21 @@
 import os
-from flask import Blueprint, request, jsonify, send_file
+from pathlib import Path
+from flask import Blueprint, request, jsonify, send_file, current_app
+from werkzeug.exceptions import HTTPException
 from werkzeug.utils import secure_filename
 import uuid
 from python_backend.utils.audio_processor import AudioProcessor
 import base64
-import json
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 # Create blueprint
 uploads_bp = Blueprint('uploads', __name__)
 
 # Define upload and transformations directories
-UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'shared', 'uploads')
-TRANSFORMATIONS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'shared', 'transformations')
+UPLOAD_FOLDER = Path(__file__).resolve().parents[2] / 'shared' / 'uploads'
+TRANSFORMATIONS_DIR = Path(__file__).resolve().parents[2] / 'shared' / 'transformations'
 
 # Ensure directories exist
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
@@ -20,6 +24,38 @@ os.makedirs(TRANSFORMATIONS_DIR, exist_ok=True)
 # Initialize audio processor
 audio_processor = AudioProcessor()
 
+# Conversions run on a background pool so /api/convert returns immediately instead of
+# holding the request open; the heavy lifting is FFmpeg and torch, which release the GIL.
+# ThreadPoolExecutor only starts threads on first submit, so this is safe to import pre-fork.
+CONVERT_WORKERS = int(os.environ.get('CONVERT_WORKERS', os.cpu_count() or 1))
+convert_executor = ThreadPoolExecutor(max_workers=CONVERT_WORKERS, thread_name_prefix='convert')
+
+# Conversion jobs keyed by '<input sha256>_<genre>': job id -> (future, output_path).
+# Successful jobs are kept so repeat requests for the same audio and genre skip the transform.
+# A job can be shared by different uploads, so nothing about the requester (such as the
+# download name, which carries their upload id) is stored with it.
+# Failed jobs stay too, so every client polling them sees the error; the next POST for the
+# same audio and genre replaces them with a fresh attempt.
+conversion_jobs = {}
+conversion_jobs_lock = threading.Lock()
+CONVERSION_JOBS_SIZE = 1024  # finished jobs remembered; outputs stay on disk either way
+
+def job_failed(job):
+    """True once a conversion job has finished without producing its output file"""
+    future, output_path = job
+    if not future.done():
+        return False
+    return future.exception() is not None or not future.result()[0] or not os.path.exists(output_path)
+
+def add_job(job_id, job):
+    """Record a job, evicting the oldest finished ones beyond CONVERSION_JOBS_SIZE (call with the lock held)"""
+    conversion_jobs.pop(job_id, None)  # re-insert at the end, as the newest
+    conversion_jobs[job_id] = job
+    # Pending jobs are never evicted: a client is still waiting on them
+    excess = len(conversion_jobs) - CONVERSION_JOBS_SIZE
+    for old_id in [old_id for old_id, (future, _) in conversion_jobs.items() if future.done()][:max(excess, 0)]:
+        del conversion_jobs[old_id]
+
 # Allowed file extensions
 ALLOWED_EXTENSIONS = {'wav', 'mp3', 'ogg', 'flac'}
 
@@ -44,7 +80,7 @@ def upload_file():
         original_filename = secure_filename(file.filename)
         unique_id = str(uuid.uuid4())
         filename = f"{unique_id}_{original_filename}"
-        filepath = os.path.join(UPLOAD_FOLDER, filename)
+        filepath = UPLOAD_FOLDER / filename
         
         # Save the file
         file.save(filepath)
@@ -54,12 +90,16 @@ def upload_file():
             'original_filename': original_filename
         }), 201
         
+    except HTTPException:
+        # e.g. 413 from MAX_CONTENT_LENGTH, raised when request.files is first read: let the
+        # app's error handlers answer it instead of reporting it as a 500
+        raise
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @uploads_bp.route('/api/convert', methods=['POST'])
 def convert_file():
-    """Convert uploaded file to target genre"""
+    """Queue conversion of an uploaded file to the target genre; poll /api/convert/<job_id> for the result"""
     try:
         print("Starting conversion process...")
         data = request.json
@@ -78,100 +118,154 @@ def convert_file():
             return jsonify({'error': 'Invalid target genre'}), 400
         
         # Get file paths
-        input_path = os.path.join(UPLOAD_FOLDER, filename)
-        if not os.path.exists(input_path):
+        input_path = UPLOAD_FOLDER / filename
+        
+        # Key the output by file content so the same audio uploaded again reuses earlier work
+        # (hashlib's SHA-256 runs through OpenSSL, which uses SHA-NI where the CPU has it).
+        # Opening the file doubles as the existence check.
+        try:
+            with input_path.open('rb') as f:
+                content_hash = hashlib.file_digest(f, 'sha256').hexdigest()
+        except FileNotFoundError:
             print(f"Input file not found: {input_path}")
             return jsonify({'error': 'File not found'}), 404
         
         print(f"Input file found at: {input_path}")
+        input_path = str(input_path)
+        job_id = f"{content_hash}_{target_genre}"
         
         # Generate output filename
         base_name = os.path.splitext(filename)[0]
         output_filename = f"{base_name}_{target_genre}.wav"
-        output_path = os.path.join(TRANSFORMATIONS_DIR, output_filename)
+        output_path = str(TRANSFORMATIONS_DIR / f"{job_id}.wav")
         print(f"Output will be saved to: {output_path}")
         
-        # Transform the file
-        print("Starting audio transformation...")
-        try:
-            success, predicted_genre, _ = audio_processor.transform_genre(input_path, output_path, target_genre)
-        except Exception as transform_error:
-            print(f"Error during transformation: {str(transform_error)}")
-            import traceback
-            print(traceback.format_exc())
-            return jsonify({'error': f'Transformation error: {str(transform_error)}'}), 500
-        
-        if not success:
-            print("Transformation failed")
-            return jsonify({'error': 'Failed to transform file'}), 500
+        # Queue the transformation (unless it is already running or done) and let the client poll
+        with conversion_jobs_lock:
+            job = conversion_jobs.get(job_id)
+            if job is not None and not job_failed(job):
+                print(f"Reusing conversion job {job_id}")
+            elif os.path.exists(output_path):
+                # Converted by an earlier run of the server; only the genre prediction is redone
+                print(f"Reusing cached conversion: {output_path}")
+                future = convert_executor.submit(
+                    lambda: (True, audio_processor.detect_genre(input_path, content_hash), target_genre)
+                )
+                add_job(job_id, (future, output_path))
+            else:
+                # New, or an earlier attempt failed: (re)run the transform.
+                # Pass the hash along so genre detection doesn't read the whole file again
+                future = convert_executor.submit(
+                    audio_processor.transform_genre, input_path, output_path, target_genre, content_hash
+                )
+                add_job(job_id, (future, output_path))
+                print(f"Queued conversion job {job_id}")
         
-        print("Transformation successful, sending file...")
-        
-        # Check if output file exists
-        if not os.path.exists(output_path):
-            print(f"Output file not found after transformation: {output_path}")
-            return jsonify({'error': 'Transformed file not found'}), 500
-        
-        # Create response with metadata
-        response = send_file(
-            output_path,
-            as_attachment=True,
-            download_name=output_filename,
-            mimetype='audio/wav'
-        )
-        
-        # Add CORS headers
-        response.headers['Access-Control-Allow-Origin'] = '*'
-        response.headers['Access-Control-Allow-Methods'] = 'POST, OPTIONS'
-        response.headers['Access-Control-Allow-Headers'] = 'Content-Type'
-        response.headers['Access-Control-Expose-Headers'] = 'x-conversion-metadata, X-Conversion-Metadata'  # Expose both cases
-        
-        # Add predicted genre to response headers
-        if predicted_genre:
-            metadata = {
-                'predictedGenre': predicted_genre
-            }
-            # Encode metadata to base64 to avoid newline issues
-            encoded_metadata = base64.b64encode(json.dumps(metadata).encode()).decode()
-            # Set header in both cases to ensure compatibility
-            response.headers['x-conversion-metadata'] = encoded_metadata
-            response.headers['X-Conversion-Metadata'] = encoded_metadata
-            print(f"Added metadata to response: {metadata}")
-            print(f"Response headers after adding metadata: {dict(response.headers)}")
-        else:
-            print("No predicted genre available to add to headers")
-
-        # Log all headers before sending
-        print("Final response headers:", dict(response.headers))
-        return response
+        # The download name belongs to this request, not the shared job: the client sends it
+        # back when polling (GET /api/convert/<jobId>?downloadName=...)
+        return jsonify({'jobId': job_id, 'downloadName': output_filename}), 202
         
+    except HTTPException:
+        # request.json raises these (oversized or malformed body); see upload_file
+        raise
     except Exception as e:
         print(f"Error during conversion: {str(e)}")
         import traceback
         print(traceback.format_exc())
         return jsonify({'error': str(e)}), 500
 
+@uploads_bp.route('/api/convert/<job_id>', methods=['GET'])
+def get_conversion(job_id):
+    """
+    Poll a conversion job; returns 202 while it is running and the transformed file once done.
+    """
+    with conversion_jobs_lock:
+        job = conversion_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Conversion job not found'}), 404
+    
+    future, output_path = job
+    if not future.done():
+        return jsonify({'jobId': job_id, 'status': 'pending'}), 202
+    
+    try:
+        success, predicted_genre, _ = future.result()
+    except Exception as transform_error:
+        print(f"Error during transformation: {str(transform_error)}")
+        import traceback
+        print(traceback.format_exc())
+        # The failed job stays put for other pollers; POST /api/convert again to retry
+        return jsonify({'error': f'Transformation error: {str(transform_error)}'}), 500
+    
+    if not success:
+        print("Transformation failed")
+        return jsonify({'error': 'Failed to transform file'}), 500
+    
+    print("Transformation successful, sending file...")
+    
+    # Check if output file exists
+    if not os.path.exists(output_path):
+        print(f"Output file not found after transformation: {output_path}")
+        return jsonify({'error': 'Transformed file not found'}), 500
+    
+    # Create response with metadata; outputs are keyed by content, so clients may reuse them
+    response = send_file(
+        output_path,
+        as_attachment=True,
+        download_name=secure_filename(request.args.get('downloadName', '')) or f"{job_id}.wav",
+        mimetype='audio/wav',
+        conditional=True,
+        max_age=3600
+    )
+    response.cache_control.public = False
+    response.cache_control.private = True
+    
+    # Add CORS headers
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    response.headers['Access-Control-Allow-Methods'] = 'GET, POST, OPTIONS'
+    response.headers['Access-Control-Allow-Headers'] = 'Content-Type'
+    response.headers['Access-Control-Expose-Headers'] = 'x-conversion-metadata, X-Conversion-Metadata'  # Expose both cases
+    
+    # Add predicted genre to response headers
+    if predicted_genre:
+        metadata = {
+            'predictedGenre': predicted_genre
+        }
+        # Encode metadata to base64 to avoid newline issues
+        encoded_metadata = base64.b64encode(current_app.json.dumps(metadata).encode()).decode()
+        # Set header in both cases to ensure compatibility
+        response.headers['x-conversion-metadata'] = encoded_metadata
+        response.headers['X-Conversion-Metadata'] = encoded_metadata
+        print(f"Added metadata to response: {metadata}")
+        print(f"Response headers after adding metadata: {dict(response.headers)}")
+    else:
+        print("No predicted genre available to add to headers")
+
+    # Log all headers before sending
+    print("Final response headers:", dict(response.headers))
+    return response
+
 @uploads_bp.route('/api/uploads/<filename>', methods=['GET'])
 def get_file(filename):
     """
     Get information about an uploaded file.
     """
-    filepath = os.path.join(UPLOAD_FOLDER, filename)
+    filepath = UPLOAD_FOLDER / filename
     
-    if not os.path.exists(filepath):
+    # One stat() both checks the file exists and gives us its size
+    try:
+        st = filepath.stat()
+    except FileNotFoundError:
         return jsonify({'error': 'File not found'}), 404
     
-    # Get file info
-    filesize = os.path.getsize(filepath)
-    
-    # Detect genre
-    detected_genre = AudioProcessor.detect_genre(filepath)
+    # Detect genre with the shared processor (model is loaded once at import)
+    detected_genre = audio_processor.detect_genre(str(filepath))
     
     # Return file information
     return jsonify({
         'filename': filename,
-        'filesize': filesize,
-        'filepath': filepath,
+        'filesize': st.st_size,
+        'filepath': str(filepath),
         'detectedGenre': detected_genre
     })
 
@@ -180,9 +274,13 @@ def download_file(filename):
     """
     Download an uploaded file.
     """
-    filepath = os.path.join(UPLOAD_FOLDER, filename)
+    filepath = UPLOAD_FOLDER / filename
     
-    if not os.path.exists(filepath):
+    if not filepath.is_file():
         return jsonify({'error': 'File not found'}), 404
     
-    return send_file(filepath, as_attachment=True)
\ No newline at end of file
+    # Uploads never change once saved, so let clients reuse them and answer Range/conditional requests
+    response = send_file(filepath, as_attachment=True, conditional=True, max_age=3600)
+    response.cache_control.public = False
+    response.cache_control.private = True
+    return response
\ No newline at end of file
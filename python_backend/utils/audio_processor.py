@@ -1,18 +1,33 @@
 import os                   # for file path operations
+import functools            # for caching filter designs
 import librosa              # for audio processing (loading, pitch shifting, time stretching, etc.)
 import soundfile as sf      # for saving audio files
+import soxr                 # for fast, high-quality resampling (installed with librosa)
 import numpy as np          # for number crunching (arrays, math)
-from scipy.signal import butter, lfilter, spectrogram  # for digital filters and spectrogram
+from scipy.signal import butter, firwin, oaconvolve, sosfilt, spectrogram  # for digital filters and spectrogram
 import subprocess           # for running terminal commands like FFmpeg
+import hashlib              # for keying the genre cache by file content
+import shutil               # for locating external binaries
+import uuid                 # for unique scratch output names
 import logging              # for logging messages
+import queue                # for handing predictions to the batching thread
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor  # for running FFmpeg jobs in parallel
 import torch               # for PyTorch model
 import torch.nn as nn
 import torch.nn.functional as F
-import torchvision.transforms as transforms  # for image transformations
 from PIL import Image      # for image processing
-import matplotlib
-matplotlib.use('Agg')  # Set backend to Agg for thread safety
-import matplotlib.pyplot as plt  # for generating spectrograms
+from matplotlib import colormaps  # for the spectrogram colormap
+from python_backend.utils.audio_processor_numba import apply_cascade, reverb_normalize, BIQUAD, COMPRESSOR
+# Rubber Band gives faster, cleaner time stretching / pitch shifting than librosa's
+# phase vocoder. pyrubberband shells out to the `rubberband` CLI, so both must exist.
+try:
+    import pyrubberband as pyrb
+    HAVE_RUBBERBAND = shutil.which('rubberband') is not None
+except ImportError:
+    pyrb = None
+    HAVE_RUBBERBAND = False
 # import tensorflow as tf
 # from tensorflow.keras.models import load_model
 # import librosa.feature
@@ -26,20 +41,177 @@ logger = logging.getLogger(__name__)
 SR = 22050  # Standard sample rate (CD quality is 44100Hz, but 22050Hz is common for processing)
 TRANSFORMATIONS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'transformations')
 MODEL_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'model', 'music_genre_cnn_weights.pth')
+GENRE_CACHE_SIZE = 1024  # predicted genres remembered per process, keyed by file content
+FFMPEG_TIMEOUT = 600  # seconds an FFmpeg transform may run before it is killed and the job fails
 
 # Ensure transformations directory exists
 os.makedirs(TRANSFORMATIONS_DIR, exist_ok=True)
 
-# Image transform for model input
-transform = transforms.Compose([
-    transforms.Resize((128, 128)),
-    transforms.ToTensor(),
-])
+# Effects that work sample by sample and can be fused into one pass (see _apply_stream_effects)
+STREAM_EFFECTS = {'lowpass', 'highpass', 'compression'}
+
+# FFmpeg filter chain for each target genre
+GENRE_FILTERS = {
+    # ROCK: Heavy distortion, compression, boosted mids and highs
+    'rock': 'compand=attacks=0:decays=0.1:points=-90/-60|-40/-10|0/-3:soft-knee=6,highpass=f=60,equalizer=f=800:width_type=o:width=2:g=8,equalizer=f=1400:width_type=o:width=2:g=12,equalizer=f=4000:width_type=o:width=2:g=9,volume=3',
+    # ELECTRONIC: Echo, filter sweeps, punchy beats
+    'electronic': 'aecho=0.9:0.9:60|90:0.7|0.5,highpass=f=60,equalizer=f=5000:width_type=o:width=2:g=5,volume=1.8',
+    # HIP-HOP: Heavy bass, slower tempo, emphasis on beats
+    'hiphop': 'equalizer=f=60:width_type=o:width=2:g=12,equalizer=f=100:width_type=o:width=2:g=10,volume=1.6',
+    # CLASSICAL: Reverb, dynamic range, orchestral effect
+    'classical': 'aecho=0.9:0.9:1000|1800:0.6|0.4,highpass=f=30,equalizer=f=700:width_type=o:width=2:g=3,volume=1.4',
+    # COUNTRY: Twangy, vocal clarity, slight reverb
+    'country': 'equalizer=f=2000:width_type=o:width=2:g=6,equalizer=f=4000:width_type=o:width=2:g=4,equalizer=f=6000:width_type=o:width=2:g=5,aecho=0.6:0.6:20|40:0.3|0.2,volume=1.5',
+}
 
 # Genre mapping
 GENRES = ['rock', 'disco', 'hiphop', 'classical', 'country']
 label_to_genre = {i: genre for i, genre in enumerate(GENRES)}
 
+def _stretch(y, sr, rate):
+    """Time stretch without changing pitch (rate > 1 speeds up)"""
+    if HAVE_RUBBERBAND:
+        # pyrubberband round-trips through float64 WAV files, so bring it back to float32
+        return pyrb.time_stretch(y, sr, rate).astype(np.float32, copy=False)
+    # 40 ms frames instead of librosa's default 2048-sample STFT: cheaper and less smeared
+    return librosa.effects.time_stretch(y, rate=rate, n_fft=int(0.04 * sr))
+
+def _pitch(y, sr, n_steps):
+    """Shift pitch by n_steps semitones without changing tempo"""
+    if HAVE_RUBBERBAND:
+        return pyrb.pitch_shift(y, sr, n_steps).astype(np.float32, copy=False)
+    return librosa.effects.pitch_shift(y, sr=sr, n_steps=n_steps, n_fft=int(0.04 * sr))
+
+def _design(btype, cutoff_hz, sr, order=4):
+    """Butterworth filter as float32 second-order sections, designed once per (type, cutoff, rate, order)"""
+    # Round the cutoff so near-identical floats (2000, 2000.0, 1999.9999999) share one cache entry
+    return _butter_sos(btype, round(float(cutoff_hz), 6), sr, order)
+
+@functools.lru_cache(maxsize=256)
+def _butter_sos(btype, cutoff_hz, sr, order):
+    # butter: creates Butterworth filter coefficients
+    # cutoff is normalized to the nyquist frequency (half the sampling rate)
+    # Every caller shares the cached array: treat it as read-only
+    return butter(order, cutoff_hz / (0.5 * sr), btype=btype, output='sos').astype(np.float32)
+
+def _partial_path(path):
+    """Unique scratch name next to path, so a finished write can be os.replace'd onto it atomically"""
+    # Same directory, so the rename never crosses filesystems; a crash leaves only this file
+    # behind and path itself is never seen half-written. FFmpeg creates it with the usual
+    # umask permissions, which the output keeps (a front-end server may read it directly)
+    return f"{path}.{uuid.uuid4().hex}.part"
+
+def _run_ffmpeg(ffmpeg_cmd):
+    """Run an FFmpeg command that writes files; raises CalledProcessError carrying FFmpeg's messages"""
+    logger.info(f"Running FFmpeg command: {' '.join(ffmpeg_cmd)}")
+    # Only errors are printed (-loglevel error); capture them for the log instead of
+    # letting them interleave on the server's stderr. No stdin: FFmpeg can't block on it.
+    try:
+        subprocess.run(ffmpeg_cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.PIPE, check=True, timeout=FFMPEG_TIMEOUT)
+    except subprocess.CalledProcessError as e:
+        logger.error(f"FFmpeg error: {e.stderr.decode(errors='replace').strip()}")
+        raise
+
+def _atempo(rate):
+    """FFmpeg atempo filters for a tempo change of rate (each atempo only accepts 0.5 to 100)"""
+    filters = []
+    while rate < 0.5:
+        filters.append('atempo=0.5')
+        rate /= 0.5
+    filters.append(f'atempo={rate}')
+    return filters
+
+@functools.lru_cache(maxsize=16)
+def _bass_fir(sr, boost):
+    """Linear-phase low shelf below 150Hz: a unit impulse plus (boost - 1) x a lowpass FIR"""
+    # 8193 taps puts the transition band within ~10Hz of 150Hz at 22050Hz, close to the
+    # hard cut of boosting STFT bins, and the symmetric kernel adds no phase shift
+    fir = firwin(8193, 150, fs=sr) * (boost - 1.0)
+    fir[len(fir) // 2] += 1.0
+    return fir.astype(np.float32)
+
+# Effect implementations: each factory takes (params, sr), does its setup once (filter
+# design, FIR kernel, delay length) and returns apply(buf, scratch) -> buf, where scratch
+# is a workspace the same size as buf
+def _pitch_shift_impl(params, sr):
+    # Shift the pitch of the audio
+    # n_steps: number of semitones to shift (positive = up, negative = down)
+    return lambda buf, scratch: _pitch(buf, sr, params)
+
+def _time_stretch_impl(params, sr):
+    # Change the tempo without affecting pitch
+    # rate > 1 speeds up, rate < 1 slows down
+    return lambda buf, scratch: _stretch(buf, sr, params)
+
+def _lowpass_impl(params, sr):
+    # Apply lowpass filter to remove high frequencies
+    # params: cutoff frequency in Hz, below which signals pass through
+    # sosfilt runs the cascade of second-order sections: stable at order 4 and,
+    # with float32 coefficients and input, it stays in float32
+    sos = _design('low', params, sr)
+    return lambda buf, scratch: sosfilt(sos, buf)
+
+def _highpass_impl(params, sr):
+    # Apply highpass filter to remove low frequencies
+    # Similar to lowpass but removes frequencies below cutoff
+    sos = _design('high', params, sr)
+    return lambda buf, scratch: sosfilt(sos, buf)
+
+def _bass_boost_impl(params, sr):
+    # Boost frequencies below 150Hz by a factor of params (a low shelf)
+    # One linear-phase FIR applied with FFT overlap-add: no STFT matrix in memory,
+    # and unlike an IIR shelf the boosted band stays in phase with the rest
+    fir = _bass_fir(sr, params)
+    return lambda buf, scratch: oaconvolve(buf, fir, mode='same')
+
+def _reverb_impl(params, sr):
+    # Custom reverb implementation using delay and decay
+    # delay_samples: number of samples to delay the signal
+    # decay: how much the delayed signal is reduced in amplitude
+    delay_samples = int(sr * params['delay'])
+    decay = params['decay']
+    # Mix in the delayed, decayed signal (a feed-forward comb,
+    # y[n] = x[n] + decay * x[n - delay]) and normalize to prevent clipping.
+    # One compiled in-place pass does both, tracking the peak as it goes.
+    return lambda buf, scratch: reverb_normalize(buf, delay_samples, decay)
+
+def _compression_impl(params, sr):
+    # Dynamic range compression
+    # threshold: level above which compression starts
+    # ratio: how much to reduce signals above threshold
+    threshold = params['threshold']
+    ratio = params['ratio']
+    
+    # Reduce the amplitude of samples above threshold (both polarities), in place
+    t, r = np.float32(threshold), np.float32(ratio)
+    def apply(buf, scratch):
+        # Branchless: sign(p) * (min(|p|, t) + max(|p| - t, 0) / r), with no boolean mask
+        # or gather/scatter. Run in 64k-sample tiles so the working set stays in L2.
+        over = np.empty(min(len(buf), 1 << 16), dtype=np.float32)
+        for i in range(0, len(buf), 1 << 16):
+            p = buf[i:i + (1 << 16)]
+            absp = np.abs(p, out=scratch[i:i + (1 << 16)])
+            o = over[:len(p)]
+            np.subtract(absp, t, out=o)
+            np.maximum(o, 0, out=o)
+            np.divide(o, r, out=o)
+            np.minimum(absp, t, out=absp)
+            np.add(absp, o, out=absp)
+            np.multiply(np.sign(p, out=o), absp, out=p)
+        return buf
+    return apply
+
+_EFFECT_IMPLS = {
+    'pitch_shift': _pitch_shift_impl,
+    'time_stretch': _time_stretch_impl,
+    'lowpass': _lowpass_impl,
+    'highpass': _highpass_impl,
+    'bass_boost': _bass_boost_impl,
+    'reverb': _reverb_impl,
+    'compression': _compression_impl,
+}
+
 # Define the SimpleCNN model class
 class SimpleCNN(nn.Module):
     def __init__(self, num_classes=5):
@@ -58,19 +230,108 @@ class SimpleCNN(nn.Module):
         x = F.relu(self.fc1(x))
         return self.fc2(x)
 
+class GenreBatcher:
+    """
+    Coalesces concurrent genre predictions into batched model calls.
+    Requests are served from many threads at once; instead of each one running its own
+    batch of 1, a single worker thread collects whatever arrives within a few milliseconds
+    (up to max_batch) and runs them through the model together.
+    """
+    
+    def __init__(self, model, device, max_batch=16, window=0.005, timeout=30):
+        self.model = model
+        self.device = device
+        self.max_batch = max_batch
+        self.window = window  # seconds to wait for more requests after the first
+        self.timeout = timeout  # seconds a caller waits for its batch before giving up
+        self.requests = None
+        self.pid = None  # process the worker thread runs in
+        self.start_lock = threading.Lock()
+    
+    def predict(self, rgb):
+        """Predict the genre of one 128x128 RGB spectrogram (blocks until its batch has run)"""
+        self._ensure_worker()
+        future = Future()
+        self.requests.put((rgb, future))
+        return future.result(timeout=self.timeout)
+    
+    def _ensure_worker(self):
+        # Start the worker on first use, not at import: threads don't survive a fork, so a
+        # batcher created before a server forks its workers would otherwise have no consumer.
+        # A new pid means this is a forked child; give it its own queue and thread.
+        if self.pid == os.getpid():
+            return
+        with self.start_lock:
+            if self.pid != os.getpid():
+                self.requests = queue.Queue()
+                threading.Thread(target=self._run, args=(self.requests,), name='genre-batcher', daemon=True).start()
+                self.pid = os.getpid()
+    
+    def _run(self, requests):
+        while True:
+            # Block for the first request, then gather any others that arrive within the window
+            batch = [requests.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(requests.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            
+            try:
+                images = _model_input(np.stack([rgb for rgb, _ in batch]), self.device)
+                with torch.inference_mode():
+                    predicted = torch.argmax(self.model(images), 1).tolist()
+                for (_, future), label in zip(batch, predicted):
+                    future.set_result(label_to_genre[label])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+
+def _model_input(rgb, device):
+    """Model tensor for a batch of 128x128 RGB spectrograms, shape (N, 128, 128, 3) uint8"""
+    # CHW floats scaled to [0, 1], what torchvision's ToTensor gave the model in training
+    images = torch.from_numpy(rgb).permute(0, 3, 1, 2).contiguous()  # NCHW layout: SimpleCNN.forward uses view()
+    if device.type == 'cuda':
+        # Copy the uint8 pixels (a quarter of the float32 bytes) from page-locked memory so the
+        # transfer is asynchronous, then convert to the model's fp16 on the GPU
+        return images.pin_memory().to(device, non_blocking=True).half().div_(255)
+    return images.float().div_(255)
+
 class AudioProcessor:
     """
     Class for audio processing and transformation using FFmpeg
     """
     
+    def __init__(self):
+        # Load the genre model once per process rather than on every request
+        self.model, self.device = AudioProcessor.load_model()
+        # Shared by every request thread so concurrent predictions run as one batch
+        self.batcher = GenreBatcher(self.model, self.device) if self.model is not None else None
+        # sha256 of file contents -> predicted genre, so re-submitted clips skip decode, STFT and model
+        self.genre_cache = {}
+        self.genre_cache_lock = threading.Lock()
+    
     @staticmethod
     def load_audio(filepath):
-        """Load audio file using librosa"""
+        """Load audio file as a mono float32 signal at SR"""
         try:
-            # librosa.load converts audio to mono and resamples to specified sample rate
-            # Returns (y, sr) where y is the time series array and sr is the sample rate
-            y, sr = librosa.load(filepath, sr=SR)
-            return y, sr
+            try:
+                # soundfile decodes straight through libsndfile, skipping librosa's audioread path
+                y, sr = sf.read(filepath, dtype='float32', always_2d=False)
+            except RuntimeError:
+                # Format libsndfile can't decode: let librosa fall back to audioread
+                # Returns (y, sr) where y is the time series array and sr is the sample rate
+                return librosa.load(filepath, sr=SR)
+            if y.ndim > 1:  # Convert stereo to mono
+                y = y.mean(axis=1, dtype=np.float32)
+            if sr != SR:
+                # Same soxr 'HQ' resampler librosa defaults to, without its wrapper overhead
+                y = soxr.resample(y, sr, SR, quality='HQ')
+            return y, SR
         except Exception as e:
             logger.error(f"Error loading audio file: {e}")
             raise
@@ -79,9 +340,14 @@ class AudioProcessor:
     def save_audio(y, sr, output_path):
         """Save audio file using soundfile"""
         try:
-            # sf.write saves audio data to a file
             # 'PCM_16' specifies 16-bit PCM encoding (CD quality)
-            sf.write(output_path, y, sr, 'PCM_16')
+            # Write in blocks of 2^18 frames (1 MiB of float32 mono) rather than one sf.write:
+            # libsndfile converts each block to int16 as it goes, so there is never a
+            # full-length int16 copy of the track in memory
+            channels = 1 if y.ndim == 1 else y.shape[1]
+            with sf.SoundFile(output_path, mode='w', samplerate=sr, channels=channels, subtype='PCM_16') as f:
+                for i in range(0, len(y), 1 << 18):
+                    f.write(y[i:i + (1 << 18)])
             return output_path
         except Exception as e:
             logger.error(f"Error saving audio file: {e}")
@@ -90,89 +356,140 @@ class AudioProcessor:
     @staticmethod
     def apply_effects(y, sr, effects):
         """Apply audio effects to a signal"""
-        processed = y.copy()
+        # Work in float32, C-contiguous throughout: every effect below is memory-bound, so half
+        # the bytes is roughly half the time, and the SciPy/numba kernels stream contiguous
+        # memory (astype also gives us our own copy to modify, even for a strided view)
+        processed = y.astype(np.float32, order='C')
+        # Workspace for intermediate results, so effects don't allocate full-length temporaries
+        scratch = np.empty_like(processed)
+        
+        # Consecutive filter/compression effects are collected and run together,
+        # so a stack of them walks the signal once instead of once per effect
+        pending = []
         
         # Apply each effect in the effects dictionary
+        for effect, params in effects.items():
+            if effect in STREAM_EFFECTS:
+                pending.append((effect, params))
+                continue
+            processed = AudioProcessor._apply_stream_effects(processed, sr, pending, scratch)
+            pending = []
+            
+            impl = _EFFECT_IMPLS.get(effect)
+            if impl is None:
+                logger.warning(f"Unknown effect skipped: {effect}")
+                continue
+            processed = impl(params, sr)(processed, scratch)
+            
+            # Pitch/time effects can change the length; keep the workspace matching
+            if scratch.shape != processed.shape:
+                scratch = np.empty_like(processed)
+        
+        return AudioProcessor._apply_stream_effects(processed, sr, pending, scratch)
+
+    @staticmethod
+    def _apply_stream_effects(processed, sr, run, scratch):
+        """Apply a run of consecutive filter/compression effects"""
+        if len(run) > 1:
+            # Several stacked effects: fuse them into one compiled pass over the signal
+            kinds, stages = AudioProcessor._cascade_stages(sr, run)
+            return apply_cascade(processed, kinds, stages)
+        for effect, params in run:
+            # A single effect: its vectorized SciPy/NumPy form is already one pass
+            processed = _EFFECT_IMPLS[effect](params, sr)(processed, scratch)
+        return processed
+
+    @staticmethod
+    def _cascade_stages(sr, run):
+        """Build the stage table apply_cascade runs for a list of (effect, params)"""
+        kinds, stages = [], []
+        for effect, params in run:
+            if effect in ('lowpass', 'highpass'):
+                # One BIQUAD stage per second-order section (sos row: b0, b1, b2, a0 == 1, a1, a2)
+                for b0, b1, b2, _, a1, a2 in _design('low' if effect == 'lowpass' else 'high', params, sr):
+                    kinds.append(BIQUAD)
+                    stages.append((b0, b1, b2, a1, a2, 0.0))
+            elif effect == 'compression':
+                kinds.append(COMPRESSOR)
+                stages.append((params['threshold'], params['ratio'], 0.0, 0.0, 0.0, 0.0))
+        return np.array(kinds, dtype=np.int64), np.array(stages, dtype=np.float64)
+
+    @staticmethod
+    def apply_effects_ffmpeg(y, sr, effects):
+        """
+        Apply the same effects as apply_effects, but as one FFmpeg filter chain.
+        FFmpeg's C filters avoid NumPy temporaries entirely; results are close to, not
+        bit-identical with, the Python path (see _effects_to_af).
+        """
+        chain = AudioProcessor._effects_to_af(effects, sr)
+        
+        # Stream raw mono float32 through FFmpeg's stdin/stdout: no temp files, no WAV headers
+        ffmpeg_cmd = ['ffmpeg', '-hide_banner', '-loglevel', 'error',
+                      '-f', 'f32le', '-ar', str(sr), '-ac', '1', '-i', 'pipe:0']
+        if chain:
+            ffmpeg_cmd += ['-af', chain]
+        ffmpeg_cmd += ['-f', 'f32le', '-ar', str(sr), '-ac', '1', 'pipe:1']
+        
+        try:
+            result = subprocess.run(
+                ffmpeg_cmd,
+                input=np.ascontiguousarray(y, dtype='<f4').tobytes(),
+                capture_output=True,
+                check=True
+            )
+        except subprocess.CalledProcessError as e:
+            logger.error(f"FFmpeg error: {e.stderr.decode(errors='replace').strip()}")
+            raise
+        # frombuffer views the (read-only) bytes; copy so callers get a writable array
+        return np.frombuffer(result.stdout, dtype='<f4').astype(np.float32)
+
+    @staticmethod
+    def _effects_to_af(effects, sr):
+        """Translate an apply_effects dictionary into an FFmpeg -af filter chain"""
+        parts = []
         for effect, params in effects.items():
             if effect == 'pitch_shift':
-                # librosa.effects.pitch_shift shifts the pitch of the audio
-                # n_steps: number of semitones to shift (positive = up, negative = down)
-                processed = librosa.effects.pitch_shift(processed, sr=sr, n_steps=params)
+                # Play back at a shifted rate (changes pitch and tempo), resample back to sr,
+                # then undo the tempo change. Works in every FFmpeg build, unlike rubberband.
+                shifted_rate = int(round(sr * 2.0 ** (params / 12.0)))
+                parts.append(f'asetrate={shifted_rate},aresample={sr}')
+                parts.extend(_atempo(sr / shifted_rate))
             
             elif effect == 'time_stretch':
-                # librosa.effects.time_stretch changes the tempo without affecting pitch
-                # rate > 1 speeds up, rate < 1 slows down
-                processed = librosa.effects.time_stretch(processed, rate=params)
+                # rate > 1 speeds up, rate < 1 slows down (same as librosa)
+                parts.extend(_atempo(params))
             
             elif effect == 'reverb':
-                # Custom reverb implementation using delay and decay
-                # delay_samples: number of samples to delay the signal
-                # decay: how much the delayed signal is reduced in amplitude
-                delay_samples = int(sr * params['delay'])
+                # Single echo tap; FFmpeg can't peak-normalize in one pass, so instead
+                # scale by the worst-case gain of the comb to rule out clipping
+                delay_ms = params['delay'] * 1000
                 decay = params['decay']
-                
-                # Create delay buffer (zero-padded array)
-                delay_buffer = np.zeros_like(processed)
-                # Add delayed signal with decay
-                delay_buffer[delay_samples:] = processed[:-delay_samples] * decay
-                
-                # Mix original and delayed signal
-                processed = processed + delay_buffer
-                
-                # Normalize to prevent clipping
-                processed = processed / np.max(np.abs(processed))
-            
-            elif effect == 'lowpass':
-                # Apply lowpass filter to remove high frequencies
-                # nyquist: half the sampling rate (highest possible frequency)
-                # cutoff: frequency below which signals pass through
-                nyquist = 0.5 * sr
-                cutoff = params / nyquist
-                # butter: creates Butterworth filter coefficients
-                # 4: filter order (higher = sharper cutoff)
-                b, a = butter(4, cutoff, btype='low')
-                # lfilter: applies the filter to the signal
-                processed = lfilter(b, a, processed)
+                parts.append(f'aecho=1:1:{delay_ms}:{decay},volume={1.0 / (1.0 + decay)}')
             
-            elif effect == 'highpass':
-                # Apply highpass filter to remove low frequencies
-                # Similar to lowpass but removes frequencies below cutoff
-                nyquist = 0.5 * sr
-                cutoff = params / nyquist
-                b, a = butter(4, cutoff, btype='high')
-                processed = lfilter(b, a, processed)
+            elif effect in ('lowpass', 'highpass'):
+                # Two biquads with the Q values of a 4th-order Butterworth, matching butter(4, ...)
+                parts.append(f'{effect}=f={params}:width_type=q:width=0.5412')
+                parts.append(f'{effect}=f={params}:width_type=q:width=1.3066')
             
             elif effect == 'bass_boost':
-                # Boost frequencies below 150Hz using Short-Time Fourier Transform (STFT)
-                # stft: converts time domain to frequency domain
-                stft = librosa.stft(processed)
-                # Get frequency bins
-                frequencies = librosa.fft_frequencies(sr=sr)
-                # Find indices of frequencies below 150Hz
-                bass_indices = frequencies < 150
-                # Apply boost to those frequencies
-                stft[bass_indices, :] *= params
-                # Convert back to time domain
-                processed = librosa.istft(stft)
+                # Low shelf at 150Hz with the boost factor expressed in dB
+                parts.append(f'bass=g={20 * np.log10(params)}:f=150')
             
             elif effect == 'compression':
-                # Dynamic range compression
-                # threshold: level above which compression starts
-                # ratio: how much to reduce signals above threshold
-                threshold = params['threshold']
-                ratio = params['ratio']
-                
-                # Apply compression
-                magnitude = np.abs(processed)
-                mask = magnitude > threshold
-                # Reduce amplitude of signals above threshold
-                processed[mask] = threshold + (processed[mask] - threshold) / ratio
-        
-        return processed
+                # Peak detection with minimal attack/release approximates the sample-wise compressor
+                parts.append(
+                    f"acompressor=threshold={params['threshold']}:ratio={params['ratio']}"
+                    ":attack=0.01:release=0.01:detection=peak"
+                )
+            
+            else:
+                logger.warning(f"Effect '{effect}' not supported, skipping")
+        return ','.join(parts)
 
     @staticmethod
+    @functools.lru_cache(maxsize=1)
     def load_model():
-        """Load the trained genre classification model"""
+        """Load the trained genre classification model (once per process, shared by every caller)"""
         try:
             device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
             # Create model instance
@@ -182,6 +499,9 @@ class AudioProcessor:
             # Load the state dict into the model
             model.load_state_dict(state_dict)
             model.eval()
+            if device.type == 'cuda':
+                # fp16 halves weight/activation traffic and runs on tensor cores
+                model.half()
             logger.info("Successfully loaded genre prediction model")
             return model, device
         except Exception as e:
@@ -189,122 +509,182 @@ class AudioProcessor:
             return None, None
 
     @staticmethod
-    def predict_genre(image_path, model, device):
-        """Predict genre from spectrogram image"""
-        try:
-            image = Image.open(image_path).convert("RGB")
-            image = transform(image).unsqueeze(0).to(device)
-            with torch.no_grad():
-                output = model(image)
-                predicted = torch.argmax(output, 1).item()
-                return label_to_genre[predicted]
-        except Exception as e:
-            logger.error(f"Error predicting genre: {e}")
-            return None
+    def spectrogram_image(audio_path):
+        """128x128 RGB (uint8) spectrogram of an audio file, as the genre model expects"""
+        # Load audio file using soundfile instead of librosa
+        y, sr = sf.read(audio_path, dtype='float32')
+        if len(y.shape) > 1:  # Convert stereo to mono if needed
+            y = np.mean(y, axis=1, dtype=np.float32)
+        
+        # Generate spectrogram using scipy
+        frequencies, times, Sxx = spectrogram(y, fs=sr, nperseg=1024, noverlap=512)
+        
+        # Convert to log scale and normalize, in place: the spectrogram is as large as the
+        # signal, so no full-size temporaries, and one min/max reduction each
+        Sxx_db = Sxx
+        np.add(Sxx_db, 1e-10, out=Sxx_db)
+        np.log10(Sxx_db, out=Sxx_db)
+        Sxx_db *= 10
+        lo, hi = Sxx_db.min(), Sxx_db.max()
+        Sxx_db -= lo
+        Sxx_db /= hi - lo
+        
+        # Convert to image: map through viridis and flip so low frequencies are at the
+        # bottom (what imshow(origin='lower') drew), then shrink straight to the model's
+        # 128x128 input. No figure, axes or layout machinery on the request path.
+        rgb = colormaps['viridis'](Sxx_db[::-1], bytes=True)[:, :, :3]
+        return np.array(Image.fromarray(rgb).resize((128, 128), Image.BILINEAR))
 
-    @staticmethod
-    def generate_spectrogram(audio_path, output_path):
-        """Generate spectrogram from audio file using only scipy"""
+    def detect_genre(self, filepath, digest=None):
+        """
+        Predict the genre of an audio file with the preloaded model (None if unavailable).
+        digest: the file's SHA-256 hex digest, if the caller already has it
+        """
+        if self.model is None:
+            return None
+        
         try:
-            # Load audio file using soundfile instead of librosa
-            y, sr = sf.read(audio_path)
-            if len(y.shape) > 1:  # Convert stereo to mono if needed
-                y = np.mean(y, axis=1)
-            
-            # Generate spectrogram using scipy
-            frequencies, times, Sxx = spectrogram(y, fs=sr, nperseg=1024, noverlap=512)
-            
-            # Convert to log scale and normalize
-            Sxx_db = 10 * np.log10(Sxx + 1e-10)
-            Sxx_db = (Sxx_db - Sxx_db.min()) / (Sxx_db.max() - Sxx_db.min())
-            
-            # Convert to image
-            plt.figure(figsize=(10, 4))
-            plt.imshow(Sxx_db, aspect='auto', origin='lower', cmap='viridis')
-            plt.axis('off')  # Hide axes
-            plt.tight_layout()
+            # Key on the whole file's content (hashing is far cheaper than decoding), so the
+            # same clip under any name or path hits, and different clips never collide
+            if digest is None:
+                with open(filepath, 'rb') as f:
+                    digest = hashlib.file_digest(f, 'sha256').hexdigest()
+            with self.genre_cache_lock:
+                if digest in self.genre_cache:
+                    return self.genre_cache[digest]
             
-            # Save as PNG
-            plt.savefig(output_path, bbox_inches='tight', pad_inches=0)
-            plt.close()
-            
-            return output_path
+            # The spectrogram goes straight from memory to the model: no PNG encode,
+            # scratch file, decode or resize in between
+            rgb = AudioProcessor.spectrogram_image(filepath)
+            predicted_genre = self.batcher.predict(rgb)
+            if predicted_genre:
+                logger.info(f"Predicted genre of input file: {predicted_genre}")
+                with self.genre_cache_lock:
+                    self.genre_cache[digest] = predicted_genre
+                    if len(self.genre_cache) > GENRE_CACHE_SIZE:
+                        # Evict the oldest entry (dicts keep insertion order)
+                        del self.genre_cache[next(iter(self.genre_cache))]
+            else:
+                logger.error("Genre prediction failed - model returned None")
+            return predicted_genre
         except Exception as e:
-            logger.error(f"Error generating spectrogram: {e}")
+            logger.error(f"Error during genre prediction: {str(e)}")
             return None
 
-    @staticmethod
-    def transform_genre(input_file, output_file, target_genre):
+    def transform_genre(self, input_file, output_file, target_genre, digest=None):
         """
         Transform an audio file to match a target genre using FFmpeg.
         Returns a tuple of (success, predicted_genre, target_genre)
+        digest: the input's SHA-256 hex digest, if the caller already has it (see detect_genre)
         """
         logger.info(f"Transforming {input_file} to {target_genre} genre...")
         
-        predicted_genre = None
-        # Load model and predict genre
-        model, device = AudioProcessor.load_model()
-        if model is not None:
-            # Generate spectrogram
-            spectrogram_path = os.path.splitext(input_file)[0] + '.png'
-            if AudioProcessor.generate_spectrogram(input_file, spectrogram_path):
-                try:
-                    predicted_genre = AudioProcessor.predict_genre(spectrogram_path, model, device)
-                    if predicted_genre:
-                        logger.info(f"Predicted genre of input file: {predicted_genre}")
-                    else:
-                        logger.error("Genre prediction failed - model returned None")
-                except Exception as e:
-                    logger.error(f"Error during genre prediction: {str(e)}")
-                finally:
-                    # Clean up spectrogram file
-                    try:
-                        os.remove(spectrogram_path)
-                    except:
-                        pass
+        # Predict the input's genre with the model loaded at startup
+        predicted_genre = self.detect_genre(input_file, digest)
+        
+        success = AudioProcessor._run_genre_filter(input_file, output_file, target_genre)
+        return success, predicted_genre, target_genre
+
+    def transform_many(self, input_file, genres, out_dir):
+        """
+        Transform an audio file to several genres, one FFmpeg process per genre in parallel.
+        Outputs are written to out_dir/<genre>.wav.
+        Returns {genre: (success, predicted_genre, genre)}, matching transform_genre.
+        """
+        # The input's genre only needs predicting once for all targets
+        predicted_genre = self.detect_genre(input_file)
         
+        # subprocess.run waits on FFmpeg without holding the GIL, so threads are enough
+        with ThreadPoolExecutor(max_workers=max(1, len(genres))) as executor:
+            futures = {
+                genre: executor.submit(
+                    AudioProcessor._run_genre_filter, input_file, os.path.join(out_dir, f"{genre}.wav"), genre
+                )
+                for genre in genres
+            }
+        return {genre: (future.result(), predicted_genre, genre) for genre, future in futures.items()}
+
+    @staticmethod
+    def _run_genre_filter(input_file, output_file, target_genre):
+        """Run the FFmpeg filter chain for target_genre; returns True if the output was written"""
         # Choose transformation based on genre
-        if target_genre == "rock":
-            # ROCK: Heavy distortion, compression, boosted mids and highs
-            ffmpeg_cmd = f'ffmpeg -y -i "{input_file}" -af "compand=attacks=0:decays=0.1:points=-90/-60|-40/-10|0/-3:soft-knee=6,highpass=f=60,equalizer=f=800:width_type=o:width=2:g=8,equalizer=f=1400:width_type=o:width=2:g=12,equalizer=f=4000:width_type=o:width=2:g=9,volume=3" "{output_file}"'
-            
-        elif target_genre == "electronic":
-            # ELECTRONIC: Echo, filter sweeps, punchy beats
-            ffmpeg_cmd = f'ffmpeg -y -i "{input_file}" -af "aecho=0.9:0.9:60|90:0.7|0.5,highpass=f=60,equalizer=f=5000:width_type=o:width=2:g=5,volume=1.8" "{output_file}"'
-            
-        elif target_genre == "hiphop":
-            # HIP-HOP: Heavy bass, slower tempo, emphasis on beats
-            ffmpeg_cmd = f'ffmpeg -y -i "{input_file}" -af "equalizer=f=60:width_type=o:width=2:g=12,equalizer=f=100:width_type=o:width=2:g=10,volume=1.6" "{output_file}"'
-            
-        elif target_genre == "classical":
-            # CLASSICAL: Reverb, dynamic range, orchestral effect
-            ffmpeg_cmd = f'ffmpeg -y -i "{input_file}" -af "aecho=0.9:0.9:1000|1800:0.6|0.4,highpass=f=30,equalizer=f=700:width_type=o:width=2:g=3,volume=1.4" "{output_file}"'
-            
-        elif target_genre == "country":
-            # COUNTRY: Twangy, vocal clarity, slight reverb
-            ffmpeg_cmd = f'ffmpeg -y -i "{input_file}" -af "equalizer=f=2000:width_type=o:width=2:g=6,equalizer=f=4000:width_type=o:width=2:g=4,equalizer=f=6000:width_type=o:width=2:g=5,aecho=0.6:0.6:20|40:0.3|0.2,volume=1.5" "{output_file}"'
-            
-        else:
+        filter_chain = GENRE_FILTERS.get(target_genre)
+        if filter_chain is None:
             logger.error(f"Genre '{target_genre}' not recognized.")
-            return False, predicted_genre, target_genre
+            return False
+        
+        # FFmpeg writes to a scratch name and the result is renamed into place once complete,
+        # so an interrupted run never leaves a truncated file that looks like a finished one
+        partial_file = _partial_path(output_file)
+        
+        # argv list, no shell: nothing to quote or inject, and no /bin/sh process per call.
+        # Always write 16-bit PCM WAV (what save_audio produces) whatever the output name,
+        # so no lossy encoder ever runs on this path.
+        ffmpeg_cmd = ['ffmpeg', '-y', '-hide_banner', '-loglevel', 'error', '-threads', '0',
+                      '-i', input_file, '-af', filter_chain,
+                      '-c:a', 'pcm_s16le', '-f', 'wav', partial_file]
         
         try:
-            # Execute FFmpeg command
-            logger.info(f"Running FFmpeg command: {ffmpeg_cmd}")
-            subprocess.run(ffmpeg_cmd, shell=True, check=True)
+            _run_ffmpeg(ffmpeg_cmd)
+            os.replace(partial_file, output_file)
             
-            # Verify the output file exists
-            if not os.path.exists(output_file):
-                logger.error(f"Output file not created: {output_file}")
-                return False, predicted_genre, target_genre
-                
             logger.info(f"Successfully transformed to {target_genre} genre: {output_file}")
-            return True, predicted_genre, target_genre
+            return True
             
-        except subprocess.CalledProcessError as e:
-            logger.error(f"FFmpeg error: {str(e)}")
-            return False, predicted_genre, target_genre
+        except subprocess.CalledProcessError:
+            return False  # already logged by _run_ffmpeg
         except Exception as e:
             logger.error(f"Error during transformation: {str(e)}")
-            return False, predicted_genre, target_genre
-    
\ No newline at end of file
+            return False
+        finally:
+            # Gone already if the rename happened; otherwise drop the incomplete output
+            try:
+                os.remove(partial_file)
+            except OSError:
+                pass
+
+    @staticmethod
+    def transform_genres_batch(input_file, outputs):
+        """
+        Transform one audio file to several genres with a single FFmpeg run.
+        outputs maps target genre -> output file. Returns True if every output was written.
+        """
+        unknown = [genre for genre in outputs if genre not in GENRE_FILTERS]
+        if unknown:
+            logger.error(f"Genres not recognized: {', '.join(unknown)}")
+            return False
+        
+        # Decode the input once and split it into one branch per genre:
+        # [0:a]asplit=N[in0][in1]...;[in0]<rock chain>[out0];[in1]<electronic chain>[out1];...
+        genres = list(outputs)
+        split = '[0:a]asplit=' + str(len(genres)) + ''.join(f'[in{i}]' for i in range(len(genres)))
+        chains = [f'[in{i}]{GENRE_FILTERS[genre]}[out{i}]' for i, genre in enumerate(genres)]
+        filter_complex = ';'.join([split] + chains)
+        
+        # Scratch names renamed into place afterwards, as in _run_genre_filter
+        partial_files = {genre: _partial_path(outputs[genre]) for genre in genres}
+        
+        ffmpeg_cmd = ['ffmpeg', '-y', '-hide_banner', '-loglevel', 'error', '-threads', '0',
+                      '-i', input_file, '-filter_complex', filter_complex]
+        for i, genre in enumerate(genres):
+            ffmpeg_cmd += ['-map', f'[out{i}]', '-c:a', 'pcm_s16le', '-f', 'wav', partial_files[genre]]
+        
+        try:
+            _run_ffmpeg(ffmpeg_cmd)
+            for genre in genres:
+                os.replace(partial_files[genre], outputs[genre])
+        except subprocess.CalledProcessError:
+            return False  # already logged by _run_ffmpeg
+        except Exception as e:
+            # e.g. no ffmpeg binary, or a rename that failed
+            logger.error(f"Error during transformation: {str(e)}")
+            return False
+        finally:
+            for partial_file in partial_files.values():
+                try:
+                    os.remove(partial_file)
+                except OSError:
+                    pass
+        
+        logger.info(f"Successfully transformed {input_file} to {', '.join(genres)}")
+        return True
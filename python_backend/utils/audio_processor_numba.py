@@ -0,0 +1,63 @@
+"""
+Numba kernels for AudioProcessor effects that can be computed sample by sample
+"""
+import numpy as np          # for number crunching (arrays, math)
+from numba import njit      # JIT compiler (installed with librosa)
+
+# Stage kinds for apply_cascade; each stage is one row of the stage table
+BIQUAD = 0      # row: b0, b1, b2, a1, a2, unused (one second-order section, a0 == 1)
+COMPRESSOR = 1  # row: threshold, ratio, unused...
+
+
+@njit(fastmath=True, cache=True)
+def apply_cascade(x, kinds, stages):
+    """
+    Run a chain of filter / compressor stages over x in a single pass, in place.
+    The whole chain is applied to each sample before moving on, so the signal is
+    streamed through memory once no matter how many effects are stacked.
+    """
+    n_stages = kinds.shape[0]
+    # Two delay registers per stage (only biquads use them)
+    state = np.zeros((n_stages, 2))
+    for n in range(x.shape[0]):
+        v = np.float64(x[n])
+        for s in range(n_stages):
+            kind = kinds[s]
+            if kind == COMPRESSOR:
+                threshold = stages[s, 0]
+                magnitude = abs(v)
+                if magnitude > threshold:
+                    compressed = threshold + (magnitude - threshold) / stages[s, 1]
+                    v = compressed if v >= 0 else -compressed
+            else:
+                # Transposed direct form II, the same recurrence scipy's sosfilt uses
+                y = stages[s, 0] * v + state[s, 0]
+                state[s, 0] = stages[s, 1] * v - stages[s, 3] * y + state[s, 1]
+                state[s, 1] = stages[s, 2] * v - stages[s, 4] * y
+                v = y
+        x[n] = v
+    return x
+
+
+@njit(fastmath=True, cache=True)
+def reverb_normalize(x, delay, decay):
+    """
+    Feed-forward comb y[n] = x[n] + decay * x[n - delay] followed by peak
+    normalization, in place. The comb walks backwards so x[n - delay] is still
+    the original sample when it is read, and the peak is tracked in the same pass.
+    """
+    n = x.shape[0]
+    peak = 0.0
+    for i in range(n - 1, -1, -1):
+        v = x[i]
+        if i >= delay:
+            v += decay * x[i - delay]
+        x[i] = v
+        magnitude = abs(v)
+        if magnitude > peak:
+            peak = magnitude
+    if peak > 0.0:
+        scale = 1.0 / peak
+        for i in range(n):
+            x[i] *= scale
+    return x
@@ -9,10 +9,11 @@ sys.path.insert(0, current_dir)
 from python_backend.app import create_app
 
 if __name__ == '__main__':
+    # Development server only; see "Running in Production" in the README for gunicorn
     app = create_app()
     
     # Get port from environment, default to 8080
     port = int(os.environ.get('PORT', 8080))
     
     # Run the app
-    app.run(host='0.0.0.0', port=port, debug=True)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=port)
\ No newline at end of file